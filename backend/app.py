@@ -1,15 +1,27 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from amadeus import Client, ResponseError
+from amadeus import Client, ResponseError, AuthenticationError
 from openai import OpenAI
 from dotenv import load_dotenv
 import os
+import re
+import socket
 import json
 import logging
-import re
-from datetime import datetime, timedelta
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.error import URLError
+from urllib.request import urlopen
+from datetime import date, datetime, timedelta
 from typing import Dict, Any, Optional
 
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to per-process refreshes
+    fcntl = None
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -37,10 +49,225 @@ if not amadeus_api_key or not amadeus_api_secret:
 if not openai_api_key:
     raise ValueError("OpenAI API key not found. Please check your .env file.")
 
+AMADEUS_HTTP_TIMEOUT = float(os.getenv('AMADEUS_HTTP_TIMEOUT', '30'))
+
+def amadeus_http(http_request):
+    """urlopen with a timeout, so a hung Amadeus call cannot stall a worker forever"""
+    try:
+        return urlopen(http_request, timeout=AMADEUS_HTTP_TIMEOUT)
+    except (socket.timeout, TimeoutError) as e:
+        # The SDK turns URLError into a NetworkError, which callers already handle
+        raise URLError(e)
+
+@contextmanager
+def file_lock(lock_path: str, timeout: float):
+    """Hold a cross-process lock on lock_path; yields False if it could not be taken in time"""
+    fd = None
+    if fcntl is not None:
+        deadline = time.monotonic() + timeout
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"Timed out waiting for {lock_path}")
+                    time.sleep(0.05)
+        except OSError as e:
+            logger.error(f"Could not lock {lock_path}: {e}")
+            if fd is not None:
+                os.close(fd)
+                fd = None
+    try:
+        yield fd is not None
+    finally:
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+def write_json_atomic(path: str, data: Dict[str, Any]) -> None:
+    """Replace path with data; mkstemp creates the temp file exclusively with 0600"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class SharedAccessToken:
+    """Amadeus access token that refreshes ahead of expiry and is shared between workers.
+    
+    Drop-in replacement for the SDK's AccessToken: the client only calls
+    _bearer_token(). A background thread refreshes the token before it expires
+    and publishes it to a cache file, so pre-forked workers reuse one token and
+    only one of them calls the auth endpoint per token lifetime. If the cache
+    cannot be used, each worker falls back to fetching its own token.
+    """
+    
+    TOKEN_PATH = '/v1/security/oauth2/token'
+    # Same as the SDK: never hand out a token that expires mid-request
+    TOKEN_BUFFER = 10
+    # Beyond this, stop waiting for another worker's refresh and fetch our own token
+    LOCK_TIMEOUT = 5
+    
+    def __init__(self, client, cache_path: str, refresh_margin: int = 300):
+        self.client = client
+        self.cache_path = cache_path
+        self.lock_path = cache_path + '.lock'
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_at = 0
+        self.lifetime = 0
+        self.refreshes = 0
+        try:
+            os.makedirs(os.path.dirname(cache_path), mode=0o700, exist_ok=True)
+        except OSError as e:
+            logger.error(f"Could not create Amadeus token cache directory: {e}")
+        self._reset_after_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+    
+    def _reset_after_fork(self) -> None:
+        # Threads and held locks do not survive fork; start fresh in each worker
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._pid = os.getpid()
+    
+    def _bearer_token(self) -> str:
+        self._ensure_refresher()
+        if not self._is_valid(self.expires_at, self.TOKEN_BUFFER):
+            with self._lock:
+                if not self._is_valid(self.expires_at, self.TOKEN_BUFFER):
+                    # Cold start: nothing usable cached yet, so this request has to wait
+                    self._refresh(min_remaining=self.TOKEN_BUFFER)
+        return f"Bearer {self.access_token}"
+    
+    def status(self) -> Dict[str, Any]:
+        return {
+            'refreshes': self.refreshes,
+            'expires_in': max(0, int(self.expires_at - time.time()))
+        }
+    
+    def _is_valid(self, expires_at: float, min_remaining: int = 0) -> bool:
+        return self.access_token is not None and expires_at - time.time() > min_remaining
+    
+    def _margin(self, lifetime: int) -> int:
+        """Refresh margin capped to half the token lifetime, so a fresh token is always accepted"""
+        return max(self.TOKEN_BUFFER, min(self.refresh_margin, lifetime // 2))
+    
+    def _ensure_refresher(self) -> None:
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        with self._lock:
+            if self._refresher is None or not self._refresher.is_alive():
+                self._refresher = threading.Thread(
+                    target=self._refresh_loop, name='amadeus-token-refresher', daemon=True
+                )
+                self._refresher.start()
+    
+    def _refresh_loop(self) -> None:
+        while True:
+            try:
+                with self._lock:
+                    self._refresh()
+                delay = self.expires_at - time.time() - self._margin(self.lifetime)
+            except Exception as e:
+                logger.error(f"Error refreshing Amadeus access token: {e}")
+                delay = 5
+            # Small per-worker offset so workers do not all hit the lock at once
+            time.sleep(max(delay, 1) + (os.getpid() % 5))
+    
+    def _refresh(self, min_remaining: Optional[int] = None) -> None:
+        """Adopt a cached token or fetch a new one; caller holds self._lock.
+        
+        Without min_remaining, a token is kept until it is within the refresh margin.
+        """
+        with file_lock(self.lock_path, self.LOCK_TIMEOUT) as locked:
+            cached = self._read_cache()
+            if cached:
+                required = min_remaining if min_remaining is not None else self._margin(cached['lifetime'])
+                if cached['expires_at'] - time.time() > required:
+                    self.access_token = cached['access_token']
+                    self.expires_at = cached['expires_at']
+                    self.lifetime = cached['lifetime']
+                    return
+            
+            response = self.client._unauthenticated_request(
+                'POST',
+                self.TOKEN_PATH,
+                {
+                    'grant_type': 'client_credentials',
+                    'client_id': self.client.client_id,
+                    'client_secret': self.client.client_secret
+                }
+            )
+            data = response.result or {}
+            try:
+                expires_in = int(data.get('expires_in') or 0)
+            except (TypeError, ValueError):
+                expires_in = 0
+            if not data.get('access_token') or expires_in <= 0:
+                # Raise the SDK's own error so callers' ResponseError handling applies
+                raise AuthenticationError(response)
+            self.access_token = data['access_token']
+            self.expires_at = time.time() + expires_in
+            self.lifetime = expires_in
+            self.refreshes += 1
+            if locked:
+                self._write_cache()
+            logger.debug(f"Refreshed Amadeus access token, expires in {expires_in}s")
+    
+    def _read_cache(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            if cached.get('client_id') != self.client.client_id:
+                return None
+            return {
+                'access_token': cached['access_token'],
+                'expires_at': float(cached['expires_at']),
+                'lifetime': int(cached['lifetime'])
+            }
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.error(f"Could not read Amadeus token cache: {e}")
+            return None
+    
+    def _write_cache(self) -> None:
+        try:
+            write_json_atomic(self.cache_path, {
+                'client_id': self.client.client_id,
+                'access_token': self.access_token,
+                'expires_at': self.expires_at,
+                'lifetime': self.lifetime
+            })
+        except OSError as e:
+            logger.error(f"Could not write Amadeus token cache: {e}")
+
 # Initialize Amadeus client
 amadeus = Client(
     client_id=amadeus_api_key,
-    client_secret=amadeus_api_secret
+    client_secret=amadeus_api_secret,
+    http=amadeus_http
+)
+
+# Share one proactively refreshed token between all worker processes
+amadeus.access_token = SharedAccessToken(
+    amadeus,
+    cache_path=os.getenv(
+        'AMADEUS_TOKEN_CACHE',
+        os.path.join(
+            os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+            'resvia',
+            'amadeus_token.json'
+        )
+    ),
+    refresh_margin=int(os.getenv('AMADEUS_TOKEN_REFRESH_MARGIN', '300'))
 )
 
 # Initialize OpenAI client (using your existing setup)
@@ -49,9 +276,293 @@ openai_client = OpenAI(
     api_key=openai_api_key,
 )
 
+class IntentExtractionMetrics:
+    """Counters for intent extraction attempts and fallbacks, aggregated across workers.
+    
+    Each worker keeps its own counts and also adds them to a JSON file shared by
+    all workers, so /api/metrics reports the same totals whichever worker answers.
+    """
+    
+    LOCK_TIMEOUT = 1
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.fallbacks = 0
+    
+    def record(self, fallback: bool) -> None:
+        with self._lock:
+            self.attempts += 1
+            if fallback:
+                self.fallbacks += 1
+        with file_lock(self.lock_path, self.LOCK_TIMEOUT) as locked:
+            if not locked:
+                return
+            counts = self._read_shared() or {'attempts': 0, 'fallbacks': 0}
+            counts['attempts'] += 1
+            if fallback:
+                counts['fallbacks'] += 1
+            try:
+                write_json_atomic(self.path, counts)
+            except OSError as e:
+                logger.error(f"Could not write intent metrics: {e}")
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            worker = self._summary(self.attempts, self.fallbacks)
+        shared = self._read_shared()
+        if shared is None:
+            # Shared file unavailable: this worker's numbers are all we have
+            return dict(worker, scope='worker')
+        return dict(self._summary(shared['attempts'], shared['fallbacks']), scope='all_workers', worker=worker)
+    
+    @staticmethod
+    def _summary(attempts: int, fallbacks: int) -> Dict[str, Any]:
+        rate = fallbacks / attempts if attempts else 0.0
+        return {
+            'attempts': attempts,
+            'fallbacks': fallbacks,
+            'fallback_rate': round(rate, 4)
+        }
+    
+    def _read_shared(self) -> Optional[Dict[str, int]]:
+        try:
+            with open(self.path) as f:
+                counts = json.load(f)
+            return {'attempts': int(counts['attempts']), 'fallbacks': int(counts['fallbacks'])}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.error(f"Could not read intent metrics: {e}")
+            return None
+
+intent_metrics = IntentExtractionMetrics(
+    os.path.join(os.path.dirname(amadeus.access_token.cache_path), 'intent_metrics.json')
+)
+
+class StreamingJSONExtractor:
+    """Incrementally find balanced JSON objects in streamed model output.
+    
+    Reasoning is skipped: text inside <think>...</think>, and everything before a
+    bare </think> (templates often pre-fill the opening tag). Prose around the
+    object is ignored. feed() returns the next candidate object text; if the
+    caller cannot use it, reject() resumes scanning from the following '{'.
+    
+    When the output starts with prose and no </think> has been seen yet, the text
+    may still be reasoning, so candidates are held back until the reasoning ends
+    or finish() is called at the end of the stream.
+    """
+    
+    THINK_OPEN = '<think>'
+    THINK_CLOSE = '</think>'
+    
+    def __init__(self):
+        self.raw = []
+        self._pending = ''
+        self._in_think = False
+        # None until the first visible character decides whether reasoning may precede the answer
+        self._answer_mode = None
+        self._finished = False
+        self._text = ''
+        self._candidate = None
+        self._restart(0)
+    
+    def feed_reasoning(self, text: str) -> None:
+        """Record reasoning streamed separately (delta.reasoning_content); content is then pure answer"""
+        self.raw.append(text)
+        if self._answer_mode is None:
+            self._answer_mode = True
+    
+    def feed(self, text: str) -> Optional[str]:
+        """Consume a chunk of content; return the next candidate object text, if any"""
+        self.raw.append(text)
+        self._filter(text)
+        return self._scan()
+    
+    def reject(self) -> Optional[str]:
+        """Discard the last candidate and return the next one found so far, if any"""
+        start = self._candidate[0]
+        self._candidate = None
+        self._restart(start + 1)
+        return self._scan()
+    
+    def finish(self) -> Optional[str]:
+        """Mark the end of the stream and release any held candidate"""
+        self._finished = True
+        if not self._in_think:
+            self._text += self._pending
+        self._pending = ''
+        return self._scan()
+    
+    @property
+    def raw_output(self) -> str:
+        return ''.join(self.raw)
+    
+    def _restart(self, pos: int) -> None:
+        self._pos = pos
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+    
+    def _filter(self, text: str) -> None:
+        """Append text outside reasoning to self._text, handling tags split across chunks"""
+        data = self._pending + text
+        self._pending = ''
+        visible = []
+        i = 0
+        while i < len(data):
+            if data.startswith(self.THINK_CLOSE, i):
+                if not self._in_think:
+                    # Bare close tag: everything before it was reasoning
+                    visible = []
+                    self._text = ''
+                    self._candidate = None
+                    self._restart(0)
+                self._in_think = False
+                self._answer_mode = True
+                i += len(self.THINK_CLOSE)
+                continue
+            if not self._in_think and data.startswith(self.THINK_OPEN, i):
+                self._in_think = True
+                i += len(self.THINK_OPEN)
+                continue
+            rest = data[i:]
+            if data[i] == '<' and (self.THINK_OPEN.startswith(rest) or self.THINK_CLOSE.startswith(rest)):
+                # Possible tag split across chunks, wait for more text
+                self._pending = rest
+                break
+            if not self._in_think:
+                if self._answer_mode is None and not data[i].isspace():
+                    self._answer_mode = data[i] in '{`'
+                visible.append(data[i])
+            i += 1
+        self._text += ''.join(visible)
+    
+    def _held(self) -> bool:
+        return not self._answer_mode and not self._finished
+    
+    def _scan(self) -> Optional[str]:
+        while self._candidate is None:
+            text = self._text
+            while self._pos < len(text):
+                char = text[self._pos]
+                self._pos += 1
+                if self._start is None:
+                    if char == '{':
+                        self._start = self._pos - 1
+                        self._depth = 1
+                    continue
+                if self._in_string:
+                    if self._escaped:
+                        self._escaped = False
+                    elif char == '\\':
+                        self._escaped = True
+                    elif char == '"':
+                        self._in_string = False
+                elif char == '"':
+                    self._in_string = True
+                elif char == '{':
+                    self._depth += 1
+                elif char == '}':
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._candidate = (self._start, self._pos)
+                        break
+            else:
+                if not self._finished or self._start is None:
+                    return None
+                # Unbalanced at end of stream: retry from the next '{'
+                self._restart(self._start + 1)
+        if self._held():
+            return None
+        start, end = self._candidate
+        return self._text[start:end]
+
 class TravelIntentExtractor:
     """Extract travel intent and parameters from natural language"""
     
+    VALID_INTENTS = ('flight_search', 'hotel_search', 'general_travel', 'greeting', 'help')
+    DATE_FIELDS = ('departure_date', 'return_date', 'check_in', 'check_out')
+    DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+    
+    @staticmethod
+    def _as_number(value: Any) -> Optional[float]:
+        """Accept ints, floats and numeric strings; None for anything else"""
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str):
+            try:
+                return float(value.strip())
+            except ValueError:
+                return None
+        return None
+    
+    @staticmethod
+    def validate_intent(intent_data: Any) -> Dict[str, Any]:
+        """Check extracted intent against the expected schema, raising ValueError if invalid.
+        
+        Bad optional fields (adults, confidence, missing_info) are normalised or
+        dropped rather than failing the whole extraction.
+        """
+        if not isinstance(intent_data, dict):
+            raise ValueError("Intent output is not a JSON object")
+        
+        if intent_data.get('intent') not in TravelIntentExtractor.VALID_INTENTS:
+            raise ValueError(f"Unknown intent: {intent_data.get('intent')!r}")
+        
+        for field in ('origin', 'destination'):
+            value = intent_data.get(field)
+            # Empty values are treated as missing info by the handlers
+            if not value:
+                continue
+            if not isinstance(value, str):
+                raise ValueError(f"Field '{field}' must be a string")
+        
+        for field in TravelIntentExtractor.DATE_FIELDS:
+            value = intent_data.get(field)
+            if not value:
+                continue
+            if not isinstance(value, str) or not TravelIntentExtractor.DATE_PATTERN.match(value):
+                raise ValueError(f"Field '{field}' must be a YYYY-MM-DD string")
+            date.fromisoformat(value)
+        
+        if 'adults' in intent_data:
+            adults = TravelIntentExtractor._as_number(intent_data['adults'])
+            if adults is not None and adults.is_integer() and adults >= 1:
+                intent_data['adults'] = int(adults)
+            else:
+                logger.debug(f"Dropping invalid adults value: {intent_data['adults']!r}")
+                del intent_data['adults']
+        
+        if 'confidence' in intent_data:
+            confidence = TravelIntentExtractor._as_number(intent_data['confidence'])
+            if confidence is not None and 0.0 <= confidence <= 1.0:
+                intent_data['confidence'] = confidence
+            else:
+                logger.debug(f"Dropping invalid confidence value: {intent_data['confidence']!r}")
+                del intent_data['confidence']
+        
+        if 'missing_info' in intent_data and not isinstance(intent_data['missing_info'], list):
+            logger.debug(f"Dropping invalid missing_info value: {intent_data['missing_info']!r}")
+            del intent_data['missing_info']
+        
+        return intent_data
+    
+    @staticmethod
+    def _first_valid(extractor: StreamingJSONExtractor, candidate: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Return the first candidate that parses and validates, rejecting the rest"""
+        while candidate is not None:
+            try:
+                return TravelIntentExtractor.validate_intent(json.loads(candidate))
+            except ValueError as e:
+                logger.debug(f"Skipping JSON candidate {candidate!r}: {e}")
+                candidate = extractor.reject()
+        return None
+    
     @staticmethod
     def extract_travel_intent(user_message: str) -> Dict[str, Any]:
         system_prompt = f"""You are a travel assistant that extracts structured information from user queries. 
@@ -74,27 +585,48 @@ class TravelIntentExtractor:
         
         Respond with ONLY a valid JSON object, no extra text, no markdown, no explanation.
         """
-        intent_json = None
+        extractor = StreamingJSONExtractor()
         try:
-            response = openai_client.chat.completions.create(
+            response_stream = openai_client.chat.completions.create(
                 model="deepseek/deepseek-r1-0528",
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_message}
                 ],
                 max_tokens=1000,
-                temperature=0.1
+                temperature=0.1,
+                stream=True
             )
-            intent_json = response.choices[0].message.content.strip()
-            # Remove any markdown formatting
-            intent_json = re.sub(r'```json\n?', '', intent_json)
-            intent_json = re.sub(r'```\n?', '', intent_json)
-            logger.debug(f"AI intent extraction raw output: {intent_json}")
-            return json.loads(intent_json)
+            intent_data = None
+            try:
+                for chunk in response_stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if getattr(delta, 'reasoning_content', None):
+                        extractor.feed_reasoning(delta.reasoning_content)
+                    if not delta.content:
+                        continue
+                    intent_data = TravelIntentExtractor._first_valid(extractor, extractor.feed(delta.content))
+                    if intent_data is not None:
+                        break
+                else:
+                    intent_data = TravelIntentExtractor._first_valid(extractor, extractor.finish())
+            finally:
+                # Stop generation as soon as a valid object has been read
+                response_stream.close()
+            
+            logger.debug(f"AI intent extraction raw output: {extractor.raw_output}")
+            if intent_data is None:
+                raise ValueError("No valid JSON object in model output")
+            
+            intent_metrics.record(fallback=False)
+            return intent_data
         except Exception as e:
             logger.error(f"Error extracting intent: {e}")
-            if intent_json is not None:
-                logger.error(f"Raw AI output: {intent_json}")
+            if extractor.raw:
+                logger.error(f"Raw AI output: {extractor.raw_output}")
+            intent_metrics.record(fallback=True)
             return {
                 "intent": "general_travel",
                 "confidence": 0.0,
@@ -676,6 +1208,15 @@ def health_check():
         'openai_connected': bool(openai_client)
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    # intent_extraction totals cover all workers; amadeus_auth is this worker's view
+    return jsonify({
+        'worker_pid': os.getpid(),
+        'intent_extraction': intent_metrics.snapshot(),
+        'amadeus_auth': amadeus.access_token.status()
+    })
+
 @app.route('/api/test', methods=['GET'])
 def test():
     return jsonify({